@@ -0,0 +1,20 @@
+# Gunicorn config for production: gunicorn -c gunicorn.conf.py main:app
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+# uvicorn.workers.UvicornWorker is deprecated; the worker now ships as uvicorn-worker
+worker_class = "uvicorn_worker.UvicornWorker"
+
+# Import main.py once in the master, so workers fork with Paddle, OpenCV and PyMuPDF
+# already imported instead of each paying the import time. Only the imports are shared:
+# the OCR model is still loaded lazily in each worker after fork (Paddle's inference
+# runtime starts its own threads and must not be created before forking).
+preload_app = True
+
+# job_store lives in process memory, so /progress and /result must hit the worker
+# that accepted the upload. Only raise this behind sticky sessions.
+workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+
+# Large scanned PDFs can keep a worker busy for minutes
+timeout = 300
+graceful_timeout = 30
@@ -1,20 +1,121 @@
+import os
+
+# --- Inference runtime flags ---
+# PaddlePaddle reads these at import time, so they must be set before paddleocr is imported.
+
+# OCR precision: fp32 (default) | fp16 | int8. fp16 is GPU-only and runs through TensorRT.
+# For int8, point OCR_REC_MODEL_DIR (and optionally OCR_DET_MODEL_DIR) at a quantized
+# export, e.g. from PaddleSlim's quant_post_static; CPU int8 runs on oneDNN kernels.
+OCR_PRECISION = os.getenv("OCR_PRECISION", "").lower()
+
+
+def model_dir(kind: str, precision: str = "fp32"):
+    """
+    Model directory for det/rec/cls. OCR_<KIND>_MODEL_DIR wins; otherwise OCR_MODEL_DIR/<kind>
+    (a persistent, pre-populated volume avoids re-downloading weights on cold start).
+    The INT8 recognizer lives in OCR_MODEL_DIR/rec_int8, next to the FP32 one.
+    None keeps PaddleOCR's default download location.
+    """
+    explicit = os.getenv(f"OCR_{kind.upper()}_MODEL_DIR")
+    if explicit:
+        return explicit
+    base = os.getenv("OCR_MODEL_DIR")
+    if not base:
+        return None
+    if kind == "rec" and precision == "int8":
+        return os.path.join(base, "rec_int8")
+    return os.path.join(base, kind)
+
+
+# Only when the quantized model is actually there: otherwise get_ocr_engine() falls back
+# to fp32, which runs with MKL-DNN off
+_int8_rec_dir = model_dir("rec", "int8")
+if OCR_PRECISION == "int8" and _int8_rec_dir and os.path.isdir(_int8_rec_dir):
+    os.environ.setdefault("FLAGS_use_mkldnn", "1")
+
+# Inference backend: gpu | cpu | onnx (empty: gpu when CUDA is available, else cpu)
+OCR_DEVICE = os.getenv("OCR_DEVICE", "").lower()
+
+# Concurrent OCR jobs per server process (see lifespan: app.state.ocr_pool)
+OCR_WORKERS = max(1, int(os.getenv("OCR_WORKERS", "2")))
+
+
+def available_cpus() -> int:
+    """
+    CPUs this process may actually use: its affinity mask, further limited by a cgroup v2
+    CPU quota (container limits), rather than os.cpu_count()'s host-wide count.
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:  # not available on macOS / Windows
+        cpus = os.cpu_count() or 1
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            cpus = min(cpus, max(1, int(quota) // int(period)))
+    except (OSError, ValueError):
+        pass
+    return cpus
+
+
+# Thread budget: WEB_CONCURRENCY processes x OCR_WORKERS jobs x OMP_NUM_THREADS threads
+# must stay <= available cores, otherwise OpenMP/MKL oversubscribe the CPU and context
+# switches dominate. Capped at 2 threads per job (the free-tier tuned value) by default;
+# explicit OMP_NUM_THREADS / MKL_NUM_THREADS still win.
+OCR_MAX_CPU_THREADS = 2
+_web_workers = max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+os.environ.setdefault(
+    "OMP_NUM_THREADS",
+    str(max(1, min(OCR_MAX_CPU_THREADS, available_cpus() // (_web_workers * OCR_WORKERS)))),
+)
+os.environ.setdefault("MKL_NUM_THREADS", os.environ["OMP_NUM_THREADS"])
+
 import io
-import traceback
+import gc
+import hashlib
+import tempfile
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass, field
 from contextlib import asynccontextmanager
-from fastapi import FastAPI, UploadFile, File, HTTPException, BackgroundTasks
-from fastapi.responses import StreamingResponse, JSONResponse, FileResponse
+from fastapi import FastAPI, UploadFile, File, HTTPException
+from fastapi.responses import Response, StreamingResponse, FileResponse
 from fastapi.staticfiles import StaticFiles
-from starlette.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from docx import Document
 import fitz  # PyMuPDF
+from pdf_text import open_pdf, page_digital_text, extract_page_range
+import paddleocr
 from paddleocr import PaddleOCR
 import numpy as np
 import cv2
+try:
+    # SIMD-accelerated (AVX2/AVX-512/NEON) hashing, ~3x faster than SHA-256 on large uploads
+    from blake3 import blake3 as upload_hasher
+except ImportError:
+    upload_hasher = hashlib.sha256
+import time
 import uuid
 import asyncio
+try:
+    # libuv-based event loop: cheaper request handling and SSE wakeups than stock asyncio
+    import uvloop
+except ImportError:
+    uvloop = None
 import json
-from threading import Lock
+import math
+import multiprocessing
+import queue
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from threading import Lock, Thread, Event
+
+# --- Logging ---
+# Per-page / per-image detail is logged at DEBUG so the hot path doesn't write to
+# stderr on every page at the default INFO level.
+logging.basicConfig(format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+logger = logging.getLogger("ocr")
+logger.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
 
 # --- App Initialization ---
 
@@ -24,6 +125,39 @@ from threading import Lock
 ocr_engine = None
 ocr_lock = Lock()
 
+# PaddleOCR 3.x accepts a list of images per ocr() call; 2.x only takes one at a time.
+# requirements.txt pins 2.x; a build without __version__ is treated as 2.x too, since
+# list input would crash its ocr()
+PADDLEOCR_BATCH_INPUT = int(getattr(paddleocr, "__version__", "2").split(".")[0]) >= 3
+
+def cuda_available() -> bool:
+    """True when the installed PaddlePaddle build has CUDA and a GPU is visible."""
+    try:
+        import paddle
+        return paddle.device.is_compiled_with_cuda() and paddle.device.cuda.device_count() > 0
+    except Exception:
+        return False
+
+
+def onnx_model_file(kind: str, path):
+    """
+    ONNX model file for det/rec/cls with OCR_DEVICE=onnx: path itself when it is a file,
+    else path/model.onnx. PaddleOCR's ONNX mode loads a single .onnx file per model, not
+    the Paddle inference dirs baked into the image, so they must be converted first
+    (paddle2onnx). Raises with the expected location when det or rec is missing.
+    """
+    if path and os.path.isdir(path):
+        path = os.path.join(path, "model.onnx")
+    if path and os.path.isfile(path):
+        return path
+    if kind == "cls":
+        return None  # angle classifier is disabled
+    raise FileNotFoundError(
+        f"OCR_DEVICE=onnx needs a converted ONNX {kind} model: "
+        f"{path or f'OCR_{kind.upper()}_MODEL_DIR'} must be a .onnx file or a directory with model.onnx"
+    )
+
+
 def get_ocr_engine():
     """
     Lazy-loads the PaddleOCR model on first use.
@@ -32,39 +166,113 @@ def get_ocr_engine():
     global ocr_engine
     with ocr_lock:
         if ocr_engine is None:
-            print("Initializing OCR engine (Lazy Load)...")
+            logger.info("Initializing OCR engine (Lazy Load)...")
             try:
+                # OCR_DEVICE: gpu | cpu | onnx; unset picks the GPU when CUDA is available.
+                # onnx runs det/rec through ONNX Runtime (SIMD CPU kernels); it needs the
+                # onnxruntime package and paddle2onnx exports (see onnx_model_file()).
+                device = OCR_DEVICE or ('gpu' if cuda_available() else 'cpu')
+                if device == 'gpu' and not cuda_available():
+                    logger.warning("OCR_DEVICE=gpu but no CUDA device is available; using cpu")
+                    device = 'cpu'
+                use_gpu = device == 'gpu'
+                use_onnx = device == 'onnx'
+
+                # PaddleOCR 2.x only applies fp16 through TensorRT, so OCR_PRECISION=fp16
+                # turns on use_tensorrt (needs a TensorRT-enabled paddlepaddle-gpu build)
+                precision = OCR_PRECISION or 'fp32'
+                if precision == 'fp16' and not use_gpu:
+                    logger.warning("OCR_PRECISION=fp16 needs the GPU (TensorRT); using fp32")
+                    precision = 'fp32'
+                use_tensorrt = precision == 'fp16'
+                rec_dir = model_dir("rec", precision)
+                if precision == 'int8' and not (rec_dir and os.path.isdir(rec_dir)):
+                    # FP32 weights can't run on INT8 kernels; PaddleOCR would fail to load
+                    logger.warning("OCR_PRECISION=int8 needs a quantized rec model at %s; using fp32", rec_dir)
+                    precision = 'fp32'
+                    rec_dir = model_dir("rec", precision)
+                det_dir, cls_dir = model_dir("det"), model_dir("cls")
+                if use_onnx:
+                    det_dir = onnx_model_file("det", det_dir)
+                    rec_dir = onnx_model_file("rec", rec_dir)
+                    cls_dir = onnx_model_file("cls", cls_dir)
+                # INT8 on CPU needs oneDNN; otherwise MKLDNN stays off to save memory
+                enable_mkldnn = os.getenv("OCR_ENABLE_MKLDNN") == "1" or (precision == 'int8' and not use_gpu)
+                logger.info("OCR device: %s (%s)", device, precision)
+
                 # Use lightweight mobile models to reduce memory usage on free tier
                 # det_limit_side_len reduces max image size during detection
-                # rec_batch_num=1 processes one line at a time
+                # rec_batch_num: text-line crops recognized per forward pass. Kept at 1 for
+                # the memory-limited free tier; OCR_REC_BATCH_NUM raises it on larger hosts
                 ocr_engine = PaddleOCR(
                     use_angle_cls=False,
                     lang='en',
-                    use_gpu=False,
+                    use_gpu=use_gpu,
+                    use_onnx=use_onnx,
+                    use_tensorrt=use_tensorrt,
+                    precision=precision,
                     show_log=False,
-                    det_model_dir=None,  # Use default lightweight model
-                    rec_model_dir=None,  # Use default lightweight model
+                    det_model_dir=det_dir,  # None: default lightweight model
+                    rec_model_dir=rec_dir,  # None: default lightweight model
+                    cls_model_dir=cls_dir,
                     det_limit_side_len=960,  # Limit detection image size
-                    rec_batch_num=1,  # Reduce batch size
-                    cpu_threads=2,  # Limit CPU threads
-                    enable_mkldnn=False  # Disable MKLDNN to save memory
+                    rec_batch_num=max(1, int(os.getenv("OCR_REC_BATCH_NUM", "1"))),  # Reduce batch size
+                    cpu_threads=int(os.environ["OMP_NUM_THREADS"]),  # Limit CPU threads
+                    enable_mkldnn=enable_mkldnn
                 )
-                print("OCR engine loaded successfully.")
+                logger.info("OCR engine loaded successfully.")
             except Exception as e:
-                print(f"Failed to load OCR engine: {e}")
-                traceback.print_exc()
+                logger.exception("Failed to load OCR engine: %s", e)
                 # Fallback or re-raise depending on strategy, 
                 # but returning None will just cause 500 on request, which is better than crash on start.
                 return None
     return ocr_engine
 
+def warm_up_ocr_engine():
+    """
+    Loads the OCR engine and runs one dummy inference, so model loading and lazy
+    kernel initialization happen before the first real request instead of during it.
+    """
+    start = time.perf_counter()
+    engine = get_ocr_engine()
+    if engine is None:
+        return
+    loaded = time.perf_counter()
+    try:
+        # A line of text rather than a blank image, so the detector finds a box and the
+        # recognition model runs too; 320 px is the detector's smallest working size
+        img = np.full((320, 320, 3), 255, dtype=np.uint8)
+        cv2.putText(img, "Warm up 123", (20, 170), cv2.FONT_HERSHEY_SIMPLEX, 1.2, (0, 0, 0), 2)
+        engine.ocr(img)
+        done = time.perf_counter()
+        logger.info(
+            "OCR engine warmed up in %.2fs (load %.2fs, first inference %.2fs)",
+            done - start, loaded - start, done - loaded,
+        )
+    except Exception as e:
+        logger.exception("OCR warmup failed: %s", e)
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # App startup logic
-    print("Application starting...")
+    logger.info("Application starting...")
+    # Bounded pool for OCR jobs, separate from the default executor used for small
+    # blocking calls. Extra uploads wait as "queued" instead of running concurrent
+    # PaddleOCR sessions that oversubscribe the CPU threads. Created here rather than at
+    # import so it lives and dies with the app (and isn't inherited by forked workers).
+    app.state.ocr_pool = ThreadPoolExecutor(max_workers=OCR_WORKERS, thread_name_prefix="ocr")
+    # Lazy loading stays the default so small instances pass health checks quickly;
+    # OCR_PRELOAD=1 trades a slower boot for no first-request model load.
+    if os.getenv("OCR_PRELOAD") == "1":
+        await asyncio.get_running_loop().run_in_executor(app.state.ocr_pool, warm_up_ocr_engine)
+    janitor = asyncio.create_task(job_janitor())
     yield
     # App shutdown logic
-    print("Shutting down...")
+    logger.info("Shutting down...")
+    janitor.cancel()
+    app.state.ocr_pool.shutdown(wait=False, cancel_futures=True)
+    if text_pool is not None:
+        text_pool.shutdown(wait=False, cancel_futures=True)
 
 app = FastAPI(title="Advanced OCR Backend", lifespan=lifespan)
 
@@ -78,249 +286,813 @@ class TextItem(BaseModel):
 
 # --- Helper Functions ---
 
-def sort_text_blocks(blocks):
+def _extract_v3(item) -> list:
+    """Text lines of one PaddleOCR 3.x result: a dict with a 'rec_texts' list."""
+    return [text for text in (item or {}).get('rec_texts') or () if text.strip()]
+
+
+def _extract_v2(item) -> list:
+    """Text lines of one PaddleOCR 2.x result: [[box, (text, score)], ...], or None."""
+    return [text for _, (text, _) in item or () if text.strip()]
+
+
+def _extract_v2_bare(item) -> list:
+    """Text lines of a PaddleOCR 2.x result whose entries carry bare strings: [[box, text], ...]."""
+    return [text for _, text in item or () if text.strip()]
+
+
+def result_extractor(result: list):
+    """
+    Picks the line extractor for a result list once, from the shape of its first
+    non-empty item (and that item's first line), so lines are not type-checked one by one.
+    """
+    first = next((item for item in result if item), None)
+    if isinstance(first, dict):
+        return _extract_v3
+    if first and isinstance(first[0][1], str):
+        return _extract_v2_bare
+    return _extract_v2
+
+
+def run_ocr_on_batch(imgs: list) -> list:
     """
-    Sorts PyMuPDF text blocks in reading order (top-to-bottom, left-to-right).
-    Blocks are tuples: (x0, y0, x1, y1, text, block_no, block_type)
+    Run PaddleOCR on a list of image arrays and return one extracted text per image.
+    PaddleOCR 3.x takes the whole list in one call, amortizing per-call dispatch overhead;
+    2.x rejects list input with detection enabled, so it is called once per image.
+    Raises if the engine can't be loaded or inference fails, so failures surface as job
+    errors instead of (cached) empty or error text.
     """
-    return sorted(blocks, key=lambda b: (b[1], b[0]))
+    for img in imgs:
+        logger.debug("Image shape = %s, dtype = %s", img.shape, img.dtype)
+
+    # Get OCR engine (lazy load)
+    engine = get_ocr_engine()
+    if engine is None:
+        raise RuntimeError("OCR engine could not be initialized (Memory Limit?)")
+
+    # Call ocr method
+    if len(imgs) == 1:
+        result = engine.ocr(imgs[0])
+    elif PADDLEOCR_BATCH_INPUT:
+        result = engine.ocr(imgs)
+    else:
+        result = []
+        for img in imgs:
+            result.extend(engine.ocr(img) or [None])
+
+    if result is None:
+        logger.debug("OCR returned None")
+        return [""] * len(imgs)
+
+    # One result per input image: 3.x gives [{'rec_texts': [...], ...}], 2.x gives
+    # [[[box, (text, score)], ...]]. The format is detected once, not per line
+    extract = result_extractor(result)
+    texts = ["\n".join(extract(item)) for item in result]
+    texts.extend([""] * (len(imgs) - len(texts)))
+    logger.debug("Total images processed: %d", len(texts))
+    return texts
 
 
 def run_ocr_on_image(img: np.ndarray) -> str:
     """
     Run PaddleOCR on an image array and return extracted text.
-    Handles PaddleOCR 3.x output format (dict with 'rec_texts' key).
     """
-    try:
-        if img is None:
-            print("DEBUG: Image is None!")
-            return ""
-        
-        print(f"DEBUG: Image shape = {img.shape}, dtype = {img.dtype}")
-        
-        # Get OCR engine (lazy load)
-        engine = get_ocr_engine()
-        if engine is None:
-            return "Error: OCR engine could not be initialized (Memory Limit?)"
-
-        # Call ocr method
-        result = engine.ocr(img)
-        
-        if result is None:
-            print("DEBUG: OCR returned None")
-            return ""
-        
-        lines = []
-        
-        # PaddleOCR 3.x returns: [{'rec_texts': [...], 'rec_scores': [...], ...}]
-        # It's a list containing one dictionary per page
-        
-        if isinstance(result, list):
-            for item in result:
-                # PaddleOCR 3.x format: item is a dict with 'rec_texts' key
-                if isinstance(item, dict):
-                    rec_texts = item.get('rec_texts', [])
-                    if rec_texts:
-                        lines.extend(rec_texts)
-                        print(f"DEBUG: Found {len(rec_texts)} text lines from rec_texts")
-                
-                # Old PaddleOCR 2.x format: item is a list of [box, (text, score)]
-                elif isinstance(item, list):
-                    for line_data in item:
-                        if isinstance(line_data, (list, tuple)) and len(line_data) >= 2:
-                            text_part = line_data[1]
-                            if isinstance(text_part, (list, tuple)) and len(text_part) >= 1:
-                                text = str(text_part[0])
-                                if text.strip():
-                                    lines.append(text)
-                            elif isinstance(text_part, str) and text_part.strip():
-                                lines.append(text_part)
-        
-        final_text = "\n".join(lines)
-        print(f"DEBUG: Total lines extracted: {len(lines)}")
-        return final_text
-        
-    except Exception as e:
-        print(f"OCR error: {e}")
-        traceback.print_exc()
+    if img is None:
+        logger.debug("Image is None!")
         return ""
+    return run_ocr_on_batch([img])[0]
+
+
+# (ndim, channels) -> cv2 conversion to 3-channel BGR; missing means use as is
+_TO_BGR_CODES = {
+    (2, 1): cv2.COLOR_GRAY2BGR,  # Grayscale
+    (3, 1): cv2.COLOR_GRAY2BGR,  # Grayscale with a channel axis
+    (3, 4): cv2.COLOR_RGBA2BGR,  # RGBA
+}
 
 
 def preprocess_image_minimal(img: np.ndarray) -> np.ndarray:
     """
     Minimal preprocessing that doesn't damage handwritten text.
     Just ensures proper format and does light cleanup.
+    3-channel BGR (the common case) is returned as is; other layouts are converted in
+    one cv2 call.
     """
     if img is None:
         return None
-    
-    # If already 3-channel BGR, return as is
-    if len(img.shape) == 3 and img.shape[2] == 3:
+
+    code = _TO_BGR_CODES.get((img.ndim, img.shape[2] if img.ndim == 3 else 1))
+    if code is None:
         return img
-    
-    # If grayscale, convert to BGR
-    if len(img.shape) == 2:
-        return cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
-    
-    # If RGBA, convert to BGR
-    if len(img.shape) == 3 and img.shape[2] == 4:
-        return cv2.cvtColor(img, cv2.COLOR_RGBA2BGR)
-    
-    return img
-
-
-def decode_image_bytes(image_bytes: bytes) -> np.ndarray:
+    return cv2.cvtColor(img, code)
+
+
+def decode_image_bytes(image_bytes: bytes, flags: int = cv2.IMREAD_COLOR) -> np.ndarray:
     """Decode image bytes to numpy array."""
     try:
         nparr = np.frombuffer(image_bytes, np.uint8)
-        img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+        img = cv2.imdecode(nparr, flags)
         return img
     except Exception as e:
-        print(f"Image decode error: {e}")
+        logger.warning("Image decode error: %s", e)
+        return None
+
+
+def render_page_image(page, dpi: int, out: np.ndarray = None):
+    """
+    Rasterize a PDF page into a BGR numpy array for OCR. Returns (img, owner).
+    The raw pixmap samples are wrapped in memory; no image codec (JPEG/PNG) is run
+    and no file is written or re-decoded.
+
+    If out is given and large enough, the page is converted straight into its top-left
+    corner, the pixmap is freed right away and owner is out. Otherwise img aliases the
+    pixmap's own sample buffer (zero-copy) and owner is the pixmap. Either way the
+    caller must keep owner referenced for as long as img is in use.
+    """
+    # Always render 3-channel RGB without alpha, so only the RGB -> BGR swap is needed
+    pix = page.get_pixmap(dpi=dpi, colorspace=fitz.csRGB, alpha=False)
+    img = np.frombuffer(pix.samples_mv, dtype=np.uint8).reshape(pix.height, pix.width, 3)
+
+    if out is not None and pix.height <= out.shape[0] and pix.width <= out.shape[1]:
+        # Single pass: the channel swap writes directly into the reusable buffer
+        view = out[:pix.height, :pix.width]
+        cv2.cvtColor(img, cv2.COLOR_RGB2BGR, dst=view)
+        return view, out
+
+    # Swap channels in place: no second page-sized allocation, and img stays contiguous
+    cv2.cvtColor(img, cv2.COLOR_RGB2BGR, dst=img)
+    return img, pix
+
+
+# --- Upload sources ---
+# An upload is held either as bytes (small files) or as the path of a spooled
+# temp file (large files); see spool_upload().
+
+# Large JPEG uploads (phone photos) are decoded at reduced scale: PaddleOCR shrinks images
+# for detection anyway, and JPEG decodes at 1/2, 1/4 or 1/8 scale straight from the DCT
+# coefficients for a fraction of the cost of a full decode. Other formats gain nothing
+# from a reduced decode, so they are always decoded in full.
+LARGE_IMAGE_BYTES = 4_000_000
+OCR_MAX_IMAGE_SIDE = 2400
+_REDUCED_DECODE_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+
+def _decode_image(source, flags: int) -> np.ndarray:
+    if isinstance(source, str):
+        return cv2.imread(source, flags)
+    return decode_image_bytes(source, flags)
+
+
+def jpeg_size(f):
+    """
+    (width, height) from a JPEG's frame header, reading only the marker segments before
+    it; None when f is not a JPEG. f is a binary file object positioned at the start.
+    """
+    if f.read(2) != b"\xff\xd8":
+        return None
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            return None
+        code = marker[1]
+        if code == 0xFF:  # fill byte before the actual marker
+            f.seek(-1, io.SEEK_CUR)
+            continue
+        if code == 0x01 or 0xD0 <= code <= 0xD8:  # markers without a length
+            continue
+        length = int.from_bytes(f.read(2), "big")
+        # SOF0-SOF15, except DHT (C4), JPG (C8) and DAC (CC) which share the range
+        if 0xC0 <= code <= 0xCF and code not in (0xC4, 0xC8, 0xCC):
+            frame = f.read(5)  # precision, height, width
+            if len(frame) < 5:
+                return None
+            return int.from_bytes(frame[3:5], "big"), int.from_bytes(frame[1:3], "big")
+        if length < 2:
+            return None
+        f.seek(length - 2, io.SEEK_CUR)
+
+
+def read_image(source) -> np.ndarray:
+    """
+    Decodes an upload source to a numpy image array.
+    JPEGs over LARGE_IMAGE_BYTES are decoded once, at the smallest reduction that brings
+    the long edge down to OCR_MAX_IMAGE_SIDE (at most 1/8); the size comes from the header.
+    """
+    size = os.path.getsize(source) if isinstance(source, str) else len(source)
+    if size <= LARGE_IMAGE_BYTES:
+        return _decode_image(source, cv2.IMREAD_COLOR)
+
+    if isinstance(source, str):
+        with open(source, "rb") as f:
+            dims = jpeg_size(f)
+    else:
+        dims = jpeg_size(io.BytesIO(source))
+    if not dims:
+        return _decode_image(source, cv2.IMREAD_COLOR)
+
+    long_edge = max(dims)
+    factor = next((f for f in (1, 2, 4) if long_edge / f <= OCR_MAX_IMAGE_SIDE), 8)
+    logger.debug("Decoding %d px JPEG at 1/%d scale", long_edge, factor)
+    return _decode_image(source, _REDUCED_DECODE_FLAGS[factor])
+
+
+def release_source(source):
+    """Deletes the temp file behind a spooled upload, if any."""
+    if isinstance(source, str):
+        try:
+            os.remove(source)
+        except OSError as e:
+            logger.warning("Failed to remove spooled upload %s: %s", source, e)
+
+
+# Default render DPI for scanned pages. PaddleOCR resizes internally, so 300 DPI mostly
+# adds pixels (2.25x at 300 vs 200) to rasterize, copy and run detection over.
+OCR_RENDER_DPI = int(os.getenv("OCR_RENDER_DPI", "200"))
+# Floor for per-page render DPI; below this PaddleOCR starts missing small print
+OCR_MIN_DPI = 100
+
+A4_AREA_PT = 595 * 842
+SMALL_PAGE_AREA_PT = 4 * 72 * 72  # 4 square inches, e.g. receipts
+# An embedded image only sets the render DPI when it covers this share of the page
+SCAN_IMAGE_MIN_COVERAGE = 0.8
+
+
+def page_size_dpi(page, base_dpi: int) -> int:
+    """
+    Scales the render DPI to the page size: pages larger than A4 already carry enough
+    pixels at 150 DPI, while very small pages (receipts) get 250 DPI for their fine print.
+    """
+    area = page.rect.width * page.rect.height
+    if area > A4_AREA_PT * 1.05:
+        return min(base_dpi, 150)
+    if area < SMALL_PAGE_AREA_PT:
+        return max(base_dpi, 250)
+    return base_dpi
+
+
+def choose_render_dpi(page, base_dpi: int) -> int:
+    """
+    Picks the rasterization DPI for a scanned page.
+    Starts from the page-size based DPI, then matches the native resolution of the page's
+    largest embedded image when it covers most of the page (a full-page scan), so
+    low-resolution scans aren't upsampled into extra pixels the OCR model has to process.
+    Other pages (no images, small logos or figures next to real text, or higher-resolution
+    scans) use the page-size based DPI.
+    """
+    max_dpi = page_size_dpi(page, base_dpi)
+    dpi = max_dpi
+    best_area = SCAN_IMAGE_MIN_COVERAGE * page.rect.width * page.rect.height
+    for info in page.get_image_info():
+        x0, y0, x1, y1 = info["bbox"]
+        area = (x1 - x0) * (y1 - y0)
+        if area < best_area:
+            continue
+        best_area = area
+        # Longest sides on both ends, so images placed with a 90 degree rotation still match
+        dpi = max(info["width"], info["height"]) / (max(x1 - x0, y1 - y0) / 72)
+    return int(min(max(dpi, OCR_MIN_DPI), max_dpi))
+
+
+# --- Digital text extraction ---
+
+# PyMuPDF holds the GIL and a document must not be shared across threads, so large
+# documents can be split into page ranges across a small process pool instead.
+# Off by default: spawning workers costs seconds and each re-parses the PDF, while a
+# serial pass over a 70-page document takes ~0.1 s. Worth enabling only on hosts with
+# spare cores that regularly see very long digital PDFs.
+DIGITAL_TEXT_WORKERS = int(os.getenv("DIGITAL_TEXT_WORKERS", "1"))
+# Below this page count a serial pass is cheaper than shipping the PDF to workers
+DIGITAL_PARALLEL_MIN_PAGES = 64
+
+text_pool = None
+text_pool_lock = Lock()
+
+
+def get_text_pool():
+    """Lazily creates the digital-text process pool; None when parallelism is disabled."""
+    global text_pool
+    if DIGITAL_TEXT_WORKERS < 2:
+        return None
+    with text_pool_lock:
+        if text_pool is None:
+            # spawn: never fork a process running OCR threads. Under gunicorn/uvicorn
+            # (main:app) workers import only pdf_text; with `python main.py`, spawn
+            # re-imports main.py as __mp_main__ in each worker, loading PaddleOCR and
+            # FastAPI there too. That is acceptable for local development only.
+            text_pool = ProcessPoolExecutor(
+                max_workers=DIGITAL_TEXT_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+    return text_pool
+
+
+def extract_digital_pages(doc, source, on_progress=None, known=None) -> list:
+    """
+    Returns the digital text of every page of an open document, in page order.
+    known maps page index -> text already extracted (e.g. by probe_scanned) and is
+    reused in the serial pass. With DIGITAL_TEXT_WORKERS > 1, large spooled documents
+    are extracted in parallel page ranges, each worker opening the file itself;
+    in-memory uploads stay serial rather than pickling the whole PDF once per range.
+    on_progress(done_pages) is called as pages complete.
+    """
+    pages = len(doc)
+    known = known or {}
+    parallel = isinstance(source, str) and pages >= DIGITAL_PARALLEL_MIN_PAGES
+    pool = get_text_pool() if parallel else None
+
+    if pool is None:
+        page_texts = []
+        for i in range(pages):
+            text = known.get(i)
+            page_texts.append(text if text is not None else page_digital_text(doc[i]))
+            if on_progress:
+                on_progress(i + 1)
+        return page_texts
+
+    step = math.ceil(pages / DIGITAL_TEXT_WORKERS)
+    futures = [
+        pool.submit(extract_page_range, source, start, min(start + step, pages))
+        for start in range(0, pages, step)
+    ]
+    page_texts = []
+    for future in futures:
+        page_texts.extend(future.result())
+        if on_progress:
+            on_progress(len(page_texts))
+    return page_texts
+
+
+# Clearly scanned PDFs are recognized from a few sample pages, without a digital pass
+# over the rest
+SCAN_PROBE_MIN_CHARS = 20
+
+
+def is_full_page_image(page) -> bool:
+    """True when one embedded image covers most of the page, as on a scanned page."""
+    min_area = SCAN_IMAGE_MIN_COVERAGE * page.rect.width * page.rect.height
+    return any(
+        (x1 - x0) * (y1 - y0) >= min_area
+        for x0, y0, x1, y1 in (info["bbox"] for info in page.get_image_info())
+    )
+
+
+def probe_scanned(doc):
+    """
+    Samples the first, middle and last page. Returns (scanned, texts): texts maps each
+    sampled page index to its digital text. scanned is True only when every sample lacks
+    a text layer and is a full-page image; anything else (text found, or image-only
+    covers and exhibits mixed with other pages) is inconclusive, and the caller does the
+    full digital pass, reusing texts.
+    """
+    pages = len(doc)
+    texts = {}
+    scanned = True
+    for i in sorted({0, pages // 2, pages - 1}) if pages else ():
+        page = doc[i]
+        texts[i] = page_digital_text(page)
+        if len(texts[i]) >= SCAN_PROBE_MIN_CHARS or not is_full_page_image(page):
+            scanned = False
+    return scanned, texts
+
+
+# --- Scanned PDF pipeline ---
+
+# Pages are OCR'd in micro-batches: a batch is launched once it holds OCR_BATCH_SIZE
+# pages, or once its oldest page has waited OCR_BATCH_TIMEOUT_MS. Only PaddleOCR 3.x
+# takes a batch in one call; 2.x would OCR the pages one by one anyway, so there each
+# page goes to OCR as soon as it is rendered instead of waiting for a batch to fill.
+OCR_BATCH_SIZE = max(1, int(os.getenv("OCR_BATCH_SIZE", "4"))) if PADDLEOCR_BATCH_INPUT else 1
+OCR_BATCH_TIMEOUT_MS = int(os.getenv("OCR_BATCH_TIMEOUT_MS", "250"))
+
+# Rendered pages waiting for OCR. Bounded so rasterization can't run far ahead of OCR
+# and pile up full-resolution page images in memory (~12 MB each at 200 DPI A4), but
+# large enough to hold a full batch so the next one is rendered during OCR. Rendering
+# is much faster than OCR, so a couple of pages ahead is enough with unbatched OCR.
+RENDER_QUEUE_SIZE = max(2, OCR_BATCH_SIZE)
+
+
+class PageBufferPool:
+    """
+    Reusable page-sized BGR buffers for one scanned-PDF pipeline run.
+    Buffers are allocated lazily up to capacity and then recycled instead of allocating
+    (and fragmenting the heap with) a fresh page-sized array per page. LIFO, so the most
+    recently released, cache-warm buffer is handed out first.
+    """
+
+    def __init__(self, shape, capacity: int):
+        self.shape = shape
+        self.capacity = capacity
+        self._free = queue.LifoQueue()
+        self._created = 0
+        self._lock = Lock()
+
+    def acquire(self, stop: Event):
+        """Returns a free buffer, blocking while all are in flight; None once stop is set."""
+        try:
+            return self._free.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.capacity:
+                self._created += 1
+                return np.empty(self.shape, dtype=np.uint8)
+        while not stop.is_set():
+            try:
+                return self._free.get(timeout=0.1)
+            except queue.Empty:
+                continue
         return None
 
+    def release(self, buf: np.ndarray):
+        self._free.put(buf)
+
+
+def _put_until_stopped(q: queue.Queue, item, stop: Event) -> bool:
+    """Blocking put that gives up once the consumer has signalled stop."""
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
 
-def process_digital_pdf(file_bytes: bytes) -> str:
+def render_pages_worker(doc, dpi: int, render_q: queue.Queue, stop: Event, pool: PageBufferPool):
     """
-    Extracts text from a digitally-native PDF, preserving layout.
+    Producer stage: rasterizes each page (at its choose_render_dpi) into a pool buffer and pushes
+    (page_idx, img, owner) into render_q; owner is the pool buffer (or, for pages too
+    large for it, the pixmap) backing img, released once OCR is done with it.
+    Always finishes with a sentinel: None on success, or the exception that stopped it.
     """
-    all_page_texts = []
+    sentinel = None
     try:
-        with fitz.open(stream=file_bytes, filetype="pdf") as doc:
-            for page in doc:
-                blocks = page.get_text("blocks")
-                sorted_blocks = sort_text_blocks(blocks)
-                page_text = "\n".join([b[4].strip() for b in sorted_blocks if b[4].strip()])
-                all_page_texts.append(page_text)
-                
+        for i, page in enumerate(doc):
+            buf = pool.acquire(stop)
+            if buf is None:
+                return
+            img, owner = render_page_image(page, choose_render_dpi(page, dpi), out=buf)
+            if owner is not buf:
+                pool.release(buf)
+            if not _put_until_stopped(render_q, (i, img, owner), stop):
+                return
     except Exception as e:
-        print("--- ERROR IN process_digital_pdf ---")
-        traceback.print_exc()
-        print("--------------------------------------")
-        return ""
-            
-    return "\n\n".join(all_page_texts)
+        sentinel = e
+    _put_until_stopped(render_q, sentinel, stop)
+
+
+def ocr_scanned_pdf(doc, dpi: int, on_page_done=None) -> str:
+    """
+    Runs OCR over every page of an open scanned PDF document.
+    A render thread rasterizes upcoming pages while OCR runs on the current batch, so
+    wall time approaches max(render, ocr) instead of their sum. Page texts are
+    reassembled in page order. The caller must not touch doc until this returns.
+    """
+    render_q = queue.Queue(maxsize=RENDER_QUEUE_SIZE)
+    stop = Event()
+
+    # Buffers sized for the first page at its largest dpi (pages are usually uniform); enough
+    # for every page that can be in flight at once: queued, in the current OCR batch
+    # (OCR_BATCH_SIZE, 1 on PaddleOCR 2.x), and being rendered. 4 buffers with 2.x
+    first = doc[0].rect
+    first_dpi = page_size_dpi(doc[0], dpi)
+    pool = PageBufferPool(
+        shape=(math.ceil(first.height * first_dpi / 72) + 1, math.ceil(first.width * first_dpi / 72) + 1, 3),
+        capacity=min(len(doc), RENDER_QUEUE_SIZE + OCR_BATCH_SIZE + 1),
+    )
+
+    renderer = Thread(
+        target=render_pages_worker,
+        args=(doc, dpi, render_q, stop, pool),
+        name="pdf-render",
+        daemon=True,
+    )
+    renderer.start()
+
+    page_texts = {}
+    batch = []
+    batch_started = 0.0
+    done = False
+
+    def flush():
+        texts = run_ocr_on_batch([img for _, img, _ in batch])
+        for (page_idx, _, owner), page_text in zip(batch, texts):
+            page_texts[page_idx] = page_text
+            if isinstance(owner, np.ndarray):
+                pool.release(owner)
+        # Drops the last references to the page images and any pixmaps
+        batch.clear()
+        if on_page_done:
+            on_page_done(len(page_texts))
+
+    try:
+        while not done:
+            if batch:
+                wait = batch_started + OCR_BATCH_TIMEOUT_MS / 1000 - time.monotonic()
+                try:
+                    item = render_q.get(timeout=max(wait, 0))
+                except queue.Empty:
+                    flush()
+                    continue
+            else:
+                item = render_q.get()
+
+            if item is None:
+                done = True
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                if not batch:
+                    batch_started = time.monotonic()
+                batch.append(item)
+
+            if batch and (done or len(batch) >= OCR_BATCH_SIZE):
+                flush()
+    finally:
+        stop.set()
+        renderer.join()
+
+    return "".join(
+        f"--- Page {i+1} ---\n{page_texts[i]}\n\n"
+        for i in sorted(page_texts)
+        if page_texts[i]
+    )
 
 
 # --- Job queue / progress tracking ---
 
-# In-memory job store: job_id -> {status, progress, result, error, file_bytes}
+@dataclass
+class JobState:
+    """
+    State of one OCR job. Fields are guarded by the job's own lock, so workers and
+    progress streams of different jobs never contend with each other.
+    Each progress stream subscribes its own asyncio.Event, set on every update so streams
+    wake up immediately instead of polling; `loop` is the event loop that owns them.
+    """
+    content_type: str
+    loop: asyncio.AbstractEventLoop
+    status: str = "queued"
+    progress: int = 0
+    result: str = None
+    error: str = None
+    created_at: float = field(default_factory=time.monotonic)
+    finished_at: float = None  # set once status becomes finished/error
+    subscribers: set = field(default_factory=set, repr=False)
+    lock: Lock = field(default_factory=Lock, repr=False)
+
+    def subscribe(self) -> asyncio.Event:
+        """Registers a progress stream; returns the event set on each update."""
+        event = asyncio.Event()
+        with self.lock:
+            self.subscribers.add(event)
+        return event
+
+    def unsubscribe(self, event: asyncio.Event):
+        with self.lock:
+            self.subscribers.discard(event)
+
+    def snapshot(self):
+        """Returns (status, progress, error, result) as one consistent read."""
+        with self.lock:
+            return self.status, self.progress, self.error, self.result
+
+
+# In-memory job store: job_id -> JobState.
+# job_store_lock only guards adding/removing jobs; lookups are single dict reads.
 job_store = {}
 job_store_lock = Lock()
 
+# Finished/failed jobs are evicted this long after they end, so results don't pile up
+# forever; measured from the end so jobs that queued or ran long still get the full TTL
+JOB_TTL_SECONDS = int(os.getenv("JOB_TTL_SECONDS", "900"))
+JOB_JANITOR_INTERVAL_SECONDS = 60
+
+
+def _job_expired(job: JobState, cutoff: float) -> bool:
+    with job.lock:
+        return job.finished_at is not None and job.finished_at < cutoff
+
+
+def evict_expired_jobs() -> int:
+    """Drops jobs that finished/failed over JOB_TTL_SECONDS ago. Returns how many were removed."""
+    cutoff = time.monotonic() - JOB_TTL_SECONDS
+    with job_store_lock:
+        expired = [job_id for job_id, job in job_store.items() if _job_expired(job, cutoff)]
+        for job_id in expired:
+            del job_store[job_id]
+    return len(expired)
+
 
-def process_file_sync(job_id: str, file_bytes: bytes, content_type: str):
-    """Synchronous worker that does OCR and updates job_store. Intended to run in a thread."""
+def _wake_all(events: list):
+    for event in events:
+        event.set()
+
+
+def update_job(job_id: str, **fields):
+    """Updates a job's fields and wakes any progress stream waiting on it. Thread-safe."""
+    job = job_store.get(job_id)
+    if job is None:
+        return
+    with job.lock:
+        for name, value in fields.items():
+            setattr(job, name, value)
+        if fields.get("status") in ("finished", "error") and job.finished_at is None:
+            job.finished_at = time.monotonic()
+        waiters = list(job.subscribers)
+    if not waiters:
+        return
+    try:
+        job.loop.call_soon_threadsafe(_wake_all, waiters)
+    except RuntimeError:
+        # Event loop already closed (shutdown); nobody is listening
+        pass
+
+
+async def job_janitor():
+    """Background task: periodically evicts expired jobs."""
+    while True:
+        await asyncio.sleep(JOB_JANITOR_INTERVAL_SECONDS)
+        evicted = evict_expired_jobs()
+        if evicted:
+            logger.info("Evicted %d expired jobs", evicted)
+
+
+# --- Result cache ---
+
+# Extracted text keyed by content hash, so re-uploading the same file skips OCR.
+# Bounded LRU: oldest entries are dropped once OCR_CACHE_SIZE is reached.
+OCR_CACHE_SIZE = int(os.getenv("OCR_CACHE_SIZE", "64"))
+result_cache = OrderedDict()
+result_cache_lock = Lock()
+
+
+def cache_key_for(digest: str, content_type: str) -> str:
+    """Cache key for an upload's content hash; content type is included since it selects the pipeline."""
+    return f"{content_type}:{digest}"
+
+
+def get_cached_result(key: str):
+    with result_cache_lock:
+        text = result_cache.get(key)
+        if text is not None:
+            result_cache.move_to_end(key)
+        return text
+
+
+def set_cached_result(key: str, text: str):
+    if OCR_CACHE_SIZE <= 0:
+        return
+    with result_cache_lock:
+        result_cache[key] = text
+        result_cache.move_to_end(key)
+        while len(result_cache) > OCR_CACHE_SIZE:
+            result_cache.popitem(last=False)
+
+
+def process_file_sync(job_id: str, source, content_type: str, cache_key: str = None):
+    """
+    Synchronous worker that does OCR and updates job_store. Intended to run in a thread.
+    Releases the upload source when done.
+    """
     try:
-        with job_store_lock:
-            job_store[job_id]["status"] = "processing"
-            job_store[job_id]["progress"] = 0
+        update_job(job_id, status="processing", progress=0)
 
         text = ""
         
         if content_type == "application/pdf":
             # Try digital extraction first
             try:
-                with fitz.open(stream=file_bytes, filetype="pdf") as doc:
+                with open_pdf(source) as doc:
                     pages = len(doc)
-                    digital_text = ""
-                    
-                    for i, page in enumerate(doc):
-                        # Extract digital text
-                        blocks = page.get_text("blocks")
-                        sorted_blocks = sort_text_blocks(blocks)
-                        page_text = "\n".join([b[4].strip() for b in sorted_blocks if b[4].strip()])
-                        if page_text.strip():
-                            digital_text += page_text + "\n\n"
-                        with job_store_lock:
-                            job_store[job_id]["progress"] = int(((i + 1) / pages) * 50)
+
+                    def on_digital_progress(done: int):
+                        update_job(job_id, progress=int((done / pages) * 50))
+
+                    # Sampled pages are all scans: skip the digital pass over the rest
+                    scanned, probe_texts = probe_scanned(doc)
+                    if scanned:
+                        digital_text = ""
+                    else:
+                        # Extract digital text, reusing the probed pages
+                        digital_pages = extract_digital_pages(doc, source, on_digital_progress, known=probe_texts)
+
+                        # Join once instead of growing a string page by page
+                        digital_text = "\n\n".join([t for t in digital_pages if t])
 
                     # If digital text is too short, it's likely a scanned PDF
                     if len(digital_text.strip()) < 50:
-                        print(f"Scanned PDF detected, running OCR on {pages} pages...")
-                        text = ""
-                        with fitz.open(stream=file_bytes, filetype="pdf") as doc:
-                            for i, page in enumerate(doc):
-                                # Render page as high-res image
-                                pix = page.get_pixmap(dpi=300)  # Higher DPI for better OCR
-                                
-                                # Convert to numpy array directly
-                                img_data = pix.samples
-                                img = np.frombuffer(img_data, dtype=np.uint8).reshape(pix.height, pix.width, pix.n)
-                                
-                                # Convert to BGR if needed
-                                if pix.n == 4:  # RGBA
-                                    img = cv2.cvtColor(img, cv2.COLOR_RGBA2BGR)
-                                elif pix.n == 1:  # Grayscale
-                                    img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
-                                elif pix.n == 3:  # RGB
-                                    img = cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
-                                
-                                # Run OCR
-                                page_text = run_ocr_on_image(img)
-                                if page_text:
-                                    text += f"--- Page {i+1} ---\n{page_text}\n\n"
-                                
-                                with job_store_lock:
-                                    job_store[job_id]["progress"] = 50 + int(((i + 1) / pages) * 50)
+                        logger.info("Scanned PDF detected, running OCR on %d pages...", pages)
+
+                        def on_page_done(done: int):
+                            update_job(job_id, progress=50 + int((done / pages) * 50))
+
+                        # Reuse the open document rather than parsing the PDF again.
+                        # DPI is adapted per page to its size and the scan's native resolution
+                        text = ocr_scanned_pdf(doc, dpi=OCR_RENDER_DPI, on_page_done=on_page_done)
                     else:
                         text = digital_text
                         
             except Exception as e:
-                print(f"PDF processing error: {e}")
-                traceback.print_exc()
-                with job_store_lock:
-                    job_store[job_id]["error"] = f"Failed processing PDF: {str(e)}"
-                    job_store[job_id]["status"] = "error"
+                logger.exception("PDF processing error: %s", e)
+                update_job(job_id, error=f"Failed processing PDF: {str(e)}", status="error")
                 return
 
         elif content_type and content_type.startswith("image/"):
             try:
-                print(f"Processing image with content type: {content_type}")
+                logger.debug("Processing image with content type: %s", content_type)
                 
                 # Decode image
-                img = decode_image_bytes(file_bytes)
+                img = read_image(source)
                 if img is None:
                     raise Exception("Failed to decode image")
                 
-                print(f"Image shape: {img.shape}")
+                logger.debug("Image shape: %s", img.shape)
                 
                 # Ensure proper format
                 img = preprocess_image_minimal(img)
                 
                 # Run OCR
                 text = run_ocr_on_image(img)
+                # Free the decoded image (tens of MB for photos) now rather than at return
+                del img
                 
-                print(f"Extracted text length: {len(text)}")
+                logger.debug("Extracted text length: %d", len(text))
                 
-                with job_store_lock:
-                    job_store[job_id]["progress"] = 100
+                update_job(job_id, progress=100)
                     
             except Exception as e:
-                print(f"Image processing error: {e}")
-                traceback.print_exc()
-                with job_store_lock:
-                    job_store[job_id]["error"] = f"Failed processing image: {str(e)}"
-                    job_store[job_id]["status"] = "error"
+                logger.exception("Image processing error: %s", e)
+                update_job(job_id, error=f"Failed processing image: {str(e)}", status="error")
                 return
 
         else:
-            with job_store_lock:
-                job_store[job_id]["error"] = "Unsupported file type"
-                job_store[job_id]["status"] = "error"
+            update_job(job_id, error="Unsupported file type", status="error")
             return
 
-        with job_store_lock:
-            job_store[job_id]["result"] = text if text.strip() else "No text could be extracted from this image."
-            job_store[job_id]["status"] = "finished"
-            job_store[job_id]["progress"] = 100
+        result = text if text.strip() else "No text could be extracted from this image."
+        # Only real extractions are cached; an empty result may be a transient failure
+        if cache_key and text.strip():
+            set_cached_result(cache_key, result)
+
+        update_job(job_id, result=result, status="finished", progress=100)
+        logger.info("Job %s finished (%d chars)", job_id, len(result))
 
     except Exception as e:
-        print(f"Unexpected error in process_file_sync: {e}")
-        traceback.print_exc()
-        with job_store_lock:
-            job_store[job_id]["error"] = f"Unexpected error: {str(e)}"
-            job_store[job_id]["status"] = "error"
+        logger.exception("Unexpected error in process_file_sync: %s", e)
+        update_job(job_id, error=f"Unexpected error: {str(e)}", status="error")
+    finally:
+        release_source(source)
+        # Collect the young generations once per job so reference cycles left behind by
+        # OCR results don't keep their buffers alive until a later automatic collection
+        gc.collect(1)
+
+
+# --- Upload spooling ---
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# Uploads up to this size stay in memory; larger ones are spooled to a temp file.
+# Jobs can wait in the OCR queue for a while, so keep this small: a queued job then pins
+# at most ~1 MB of RAM, and PyMuPDF reads spooled PDFs from disk on demand.
+UPLOAD_SPOOL_MAX_BYTES = int(os.getenv("UPLOAD_SPOOL_MAX_BYTES", str(UPLOAD_CHUNK_SIZE)))
+
+
+async def spool_upload(file: UploadFile):
+    """
+    Streams an upload in chunks, hashing it in the same pass.
+    Returns (source, digest, size): source is the bytes for small uploads, or the path
+    of a temp file once the upload exceeds UPLOAD_SPOOL_MAX_BYTES.
+    """
+    hasher = upload_hasher()
+    buffer = bytearray()
+    spool = None
+    size = 0
+    try:
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            hasher.update(chunk)
+            size += len(chunk)
+            if spool is None and size > UPLOAD_SPOOL_MAX_BYTES:
+                spool = tempfile.NamedTemporaryFile(prefix="ocr-upload-", delete=False)
+                await asyncio.to_thread(spool.write, buffer)
+                buffer = None
+            if spool is not None:
+                await asyncio.to_thread(spool.write, chunk)
+            else:
+                buffer.extend(chunk)
+    except BaseException:
+        if spool is not None:
+            spool.close()
+            release_source(spool.name)
+        raise
+
+    if spool is not None:
+        spool.close()
+        return spool.name, hasher.hexdigest(), size
+    return bytes(buffer), hasher.hexdigest(), size
 
 
 # --- API Endpoints ---
@@ -333,7 +1105,8 @@ async def read_index():
 async def extract_text(file: UploadFile = File(...)):
     """
     Accepts upload and starts background OCR job. Returns a job_id.
-    File is processed in-memory. No disk writes.
+    Small files are processed in-memory; large ones are spooled to a temp file
+    that is deleted once the job finishes.
     """
     # Validate content type
     if not (file.content_type == "application/pdf" or (file.content_type and file.content_type.startswith("image/"))):
@@ -341,59 +1114,97 @@ async def extract_text(file: UploadFile = File(...)):
 
     job_id = str(uuid.uuid4())
 
-    # Read file into memory
+    # Stream the upload in chunks instead of reading it whole
     try:
-        file_bytes = await file.read()
-        if not file_bytes:
+        source, digest, size = await spool_upload(file)
+        if not size:
             raise Exception("Empty file")
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Failed to read file: {str(e)}")
 
+    # Identical uploads are answered from the cache without re-running OCR
+    cache_key = cache_key_for(digest, file.content_type)
+    cached_text = get_cached_result(cache_key)
+
     # Initialize job entry
+    loop = asyncio.get_running_loop()
+    job = JobState(content_type=file.content_type, loop=loop)
+    if cached_text is not None:
+        job.status, job.progress, job.result = "finished", 100, cached_text
+        job.finished_at = job.created_at
     with job_store_lock:
-        job_store[job_id] = {
-            "status": "queued",
-            "progress": 0,
-            "result": None,
-            "error": None,
-            "content_type": file.content_type,
-        }
+        job_store[job_id] = job
 
-    # Start background processing in a thread
-    asyncio.create_task(asyncio.to_thread(process_file_sync, job_id, file_bytes, file.content_type))
+    if cached_text is not None:
+        release_source(source)
+        return {"job_id": job_id}
+
+    # Start background processing on the OCR pool
+    logger.info("Job %s queued (%s, %d bytes)", job_id, file.content_type, size)
+    try:
+        future = app.state.ocr_pool.submit(process_file_sync, job_id, source, file.content_type, cache_key)
+    except RuntimeError:
+        # Pool already shut down: the server is stopping
+        release_source(source)
+        update_job(job_id, error="Server is shutting down", status="error")
+        raise HTTPException(status_code=503, detail="Server is shutting down, please retry.")
+    # Jobs still queued at shutdown are cancelled without running process_file_sync,
+    # whose finally would otherwise remove a spooled upload
+    future.add_done_callback(lambda f: release_source(source) if f.cancelled() else None)
 
     return {"job_id": job_id}
 
 
+# A progress stream closes after this long (EventSource reconnects on its own).
+# While idle it sends an SSE comment every PROGRESS_HEARTBEAT_SECONDS so reverse
+# proxies don't drop the connection during long OCR pages.
+PROGRESS_STREAM_MAX_SECONDS = 300
+PROGRESS_HEARTBEAT_SECONDS = 15.0
+
+
 @app.get("/progress/{job_id}")
 async def progress_stream(job_id: str):
     """SSE endpoint streaming progress updates for a job."""
-    with job_store_lock:
-        if job_id not in job_store:
-            raise HTTPException(status_code=404, detail="Job not found")
+    job = job_store.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
 
     async def event_generator():
-        last_progress = -1
-        max_attempts = 600  # 5 mins at 0.5s intervals
-        attempts = 0
-        
-        while attempts < max_attempts:
-            with job_store_lock:
-                job = job_store.get(job_id, {})
-                status = job.get("status")
-                progress = job.get("progress", 0)
-                error = job.get("error")
+        # Our own event, so several streams on one job (reconnects, a second tab)
+        # don't consume each other's wakeups
+        changed = job.subscribe()
+        last_sent_state = None
+        deadline = time.monotonic() + PROGRESS_STREAM_MAX_SECONDS
+        last_sent = time.monotonic()
+
+        try:
+            while time.monotonic() < deadline:
+                # Clear before reading, so an update landing after the read re-arms the event
+                changed.clear()
+                status, progress, error, _ = job.snapshot()
 
-            if progress != last_progress or status in ("finished", "error"):
-                data = {"status": status, "progress": progress, "error": error}
-                yield f"data: {json.dumps(data)}\n\n"
-                last_progress = progress
+                if (status, progress, error) != last_sent_state:
+                    data = {"status": status, "progress": progress, "error": error}
+                    yield f"data: {json.dumps(data)}\n\n"
+                    last_sent_state = (status, progress, error)
+                    last_sent = time.monotonic()
 
-            if status in ("finished", "error"):
-                break
+                if status in ("finished", "error"):
+                    break
 
-            await asyncio.sleep(0.5)
-            attempts += 1
+                # Woken by the worker on every update, or when the next heartbeat is due
+                next_beat = last_sent + PROGRESS_HEARTBEAT_SECONDS
+                try:
+                    await asyncio.wait_for(
+                        changed.wait(),
+                        timeout=max(0.0, min(next_beat, deadline) - time.monotonic()),
+                    )
+                except asyncio.TimeoutError:
+                    if time.monotonic() >= next_beat:
+                        yield ":\n\n"
+                        last_sent = time.monotonic()
+        finally:
+            job.unsubscribe(changed)
 
     return StreamingResponse(
         event_generator(),
@@ -407,17 +1218,52 @@ async def progress_stream(job_id: str):
 
 @app.get("/result/{job_id}")
 async def get_result(job_id: str):
-    with job_store_lock:
-        job = job_store.get(job_id)
-    
+    job = job_store.get(job_id)
     if not job:
         raise HTTPException(status_code=404, detail="Job not found")
-    if job.get("status") == "finished":
-        return {"text": job.get("result")}
-    elif job.get("status") == "error":
-        raise HTTPException(status_code=500, detail=job.get("error") or "Processing error")
+
+    status, progress, error, result = job.snapshot()
+    if status == "finished":
+        return {"text": result}
+    elif status == "error":
+        raise HTTPException(status_code=500, detail=error or "Processing error")
     else:
-        return {"status": job.get("status"), "progress": job.get("progress")}
+        return {"status": status, "progress": progress}
+
+# Rendered .docx files keyed by a hash of their text (not the text itself), so repeat
+# downloads skip rebuilding the document. Kept tiny: it only needs to cover the
+# extraction a user is currently looking at.
+DOCX_CACHE_SIZE = int(os.getenv("DOCX_CACHE_SIZE", "2"))
+docx_cache = OrderedDict()
+docx_cache_lock = Lock()
+
+
+def render_docx(text: str) -> bytes:
+    """
+    Serializes text into a .docx file.
+    Memoized, so downloading the same extraction again (e.g. after a preview) skips
+    rebuilding and re-zipping the document XML.
+    """
+    key = upload_hasher(text.encode("utf-8")).hexdigest()
+    with docx_cache_lock:
+        data = docx_cache.get(key)
+        if data is not None:
+            docx_cache.move_to_end(key)
+            return data
+
+    document = Document()
+    document.add_paragraph(text)
+    file_stream = io.BytesIO()
+    document.save(file_stream)
+    data = file_stream.getvalue()
+
+    if DOCX_CACHE_SIZE > 0:
+        with docx_cache_lock:
+            docx_cache[key] = data
+            while len(docx_cache) > DOCX_CACHE_SIZE:
+                docx_cache.popitem(last=False)
+    return data
+
 
 @app.post("/download-docx")
 async def download_docx(item: TextItem):
@@ -425,18 +1271,15 @@ async def download_docx(item: TextItem):
     Converts extracted text to a .docx file and returns it for download.
     """
     try:
-        document = Document()
-        document.add_paragraph(item.text)
-        
-        # Save document to a byte stream
-        file_stream = io.BytesIO()
-        document.save(file_stream)
-        file_stream.seek(0)
-        
-        return StreamingResponse(
-            file_stream,
+        # Serialization is blocking, keep it off the event loop
+        data = await asyncio.to_thread(render_docx, item.text)
+
+        # The rendered bytes are sent as-is: no BytesIO copy, and a Content-Length
+        # header instead of chunked encoding
+        return Response(
+            content=data,
             media_type="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
-            headers={"Content-Disposition": "attachment; filename=extracted_text.docx"}
+            headers={"Content-Disposition": "attachment; filename=extracted_text.docx"},
         )
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error creating DOCX file: {e}")
@@ -447,14 +1290,10 @@ async def download_txt(item: TextItem):
     Converts extracted text to a .txt file and returns it for download.
     """
     try:
-        # Convert text to bytes
-        file_bytes = item.text.encode('utf-8')
-        file_stream = io.BytesIO(file_bytes)
-        file_stream.seek(0)
-        
-        return StreamingResponse(
-            file_stream,
-            media_type="text/plain",
+        # Encode once and send the bytes directly
+        return Response(
+            content=item.text.encode('utf-8'),
+            media_type="text/plain; charset=utf-8",
             headers={"Content-Disposition": "attachment; filename=extracted_text.txt"}
         )
     except Exception as e:
@@ -465,5 +1304,5 @@ app.mount("/", StaticFiles(directory="static", html=True), name="static")
 
 if __name__ == "__main__":
     import uvicorn
-    print("Starting server at http://0.0.0.0:8000")
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    logger.info("Starting server at http://0.0.0.0:8000")
+    uvicorn.run(app, host="0.0.0.0", port=8000, loop="uvloop" if uvloop else "asyncio")
\ No newline at end of file
@@ -0,0 +1,33 @@
+"""
+PyMuPDF text-extraction helpers.
+
+Kept separate from main.py so the digital-text process pool can import them
+without pulling in PaddleOCR / FastAPI in every worker process. This holds when the
+app is served as main:app (gunicorn/uvicorn); when started with `python main.py`,
+spawned workers re-import main.py as __mp_main__ and load everything anyway.
+"""
+import fitz  # PyMuPDF
+
+
+def open_pdf(source):
+    """Opens an upload source (bytes, or a temp file path) as a PyMuPDF document."""
+    if isinstance(source, str):
+        return fitz.open(source, filetype="pdf")
+    return fitz.open(stream=source, filetype="pdf")
+
+
+def page_digital_text(page) -> str:
+    """
+    Returns a page's embedded text in reading order (top-to-bottom, left-to-right).
+    MuPDF sorts the blocks natively, so no per-block tuples are built or sorted in Python.
+    """
+    return page.get_text("text", sort=True).strip()
+
+
+def extract_page_range(source, start: int, stop: int) -> list:
+    """
+    Returns the digital text of pages [start, stop).
+    Opens its own document, so it is safe to run in a separate process.
+    """
+    with open_pdf(source) as doc:
+        return [page_digital_text(doc[i]) for i in range(start, stop)]